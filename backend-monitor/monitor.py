@@ -7,11 +7,184 @@ Supports log files, database exports, error files, code files, and database file
 """
 
 import argparse
+import codecs
+import functools
+import io
+import mmap
+import multiprocessing
+import os
 import re
 import sys
 import sqlite3
+from array import array
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from contextlib import contextmanager
+from dataclasses import dataclass, field
 from pathlib import Path
 
+try:
+    import re2  # Optional: google-re2, a linear-time regex engine
+except ImportError:
+    re2 = None
+
+# Directory scans are spread over a process pool only when the files add up
+# to this many bytes: searching less costs less than starting the workers.
+# Forked workers start in milliseconds; spawned ones (the default on macOS
+# and Windows) each start a fresh interpreter.
+PARALLEL_MIN_BYTES = 8 * 1024 * 1024
+PARALLEL_MIN_BYTES_SPAWNED = 64 * 1024 * 1024
+
+# Files at least this large are memory-mapped rather than read
+MMAP_MIN_SIZE = 64 * 1024
+
+# Number of leading bytes checked for NUL bytes when detecting binary files
+BINARY_SNIFF_SIZE = 8192
+
+# Slice size used when processing a memory-mapped file piecewise
+MMAP_CHUNK_SIZE = 1024 * 1024
+
+# Pragmas for scanning a database read-only: a 256 MiB page cache,
+# memory-mapped reads, in-memory temp storage and no writes
+SQLITE_SCAN_PRAGMAS = (
+    'cache_size=-262144',
+    'mmap_size=30000000000',
+    'temp_store=MEMORY',
+    'query_only=1',
+)
+
+# Names SQLite accepts for a table's rowid, unless a column takes them
+ROWID_ALIASES = ('rowid', '_rowid_', 'oid')
+
+# Rows fetched per call when streaming database query results
+FETCH_BATCH_SIZE = 4096
+
+# Size of the buffer result lines are written through
+OUTPUT_BUFFER_SIZE = 1024 * 1024
+
+# ANSI escape codes for bold red, as bytes since output is written as bytes
+HIGHLIGHT_START = b'\x1b[1;31m'
+HIGHLIGHT_END = b'\x1b[0m'
+
+# Regex tokens that match single bytes in a bytes pattern, and so can stop
+# inside a multibyte UTF-8 character: any character, negated classes, class
+# escapes and numeric escapes. Other escapes are consumed whole so that an
+# escaped "\." is not taken for a dot.
+BYTE_LEVEL_TOKEN_RE = re.compile(r'\\(?:[wWbBdDsSxX0]|[1-7][0-7]{2})|\\.|\[\^|\.', re.DOTALL)
+
+# Regex tokens that make a regex be searched line by line: ones that can
+# match a newline (newline and class escapes, numeric escapes, class ranges
+# starting below \n, negated classes, the s flag, a literal newline) and
+# ones that see the string bounds (\A, \Z, \B)
+NEWLINE_TOKEN_RE = re.compile(r'\\(?:[1-7][0-7]{2}|[abt]-|.)|\[\^|\(\?[a-zA-Z]*s|\n', re.DOTALL)
+
+
+@dataclass
+class MatchSet:
+    """
+    Search matches stored as parallel arrays (structure of arrays).
+
+    Match i was found in sources[source_ids[i]], a (file, table, column)
+    tuple with table and column set to None for text files, and
+    file_names[source_ids[i]] is that file's base name as bytes, ready for
+    output. line_nums[i] is the line number, or the row for database
+    matches, and starts[i]/ends[i] are byte offsets delimiting the match
+    within lines[i], the UTF-8 bytes of the matched line. The integer
+    columns are compact arrays rather than one dict per match; array.append
+    grows them geometrically, so appends stay cheap.
+    """
+    sources: list = field(default_factory=list)
+    file_names: list = field(default_factory=list)
+    source_ids: array = field(default_factory=lambda: array('q'))
+    line_nums: array = field(default_factory=lambda: array('q'))
+    starts: array = field(default_factory=lambda: array('q'))
+    ends: array = field(default_factory=lambda: array('q'))
+    lines: list = field(default_factory=list)
+    _source_index: dict = field(default_factory=dict, repr=False, compare=False)
+
+    def __len__(self):
+        return len(self.lines)
+
+    def __getstate__(self):
+        # Matches travel back from pool workers by pickle. The integer
+        # columns already pickle as raw buffers; pack the lines into one
+        # bytes object too (they never contain newlines) so the pickler handles
+        # a few large objects instead of one object per match.
+        return {
+            'sources': self.sources,
+            'file_names': self.file_names,
+            'source_ids': self.source_ids,
+            'line_nums': self.line_nums,
+            'starts': self.starts,
+            'ends': self.ends,
+            'lines': b'\n'.join(self.lines),
+        }
+
+    def __setstate__(self, state):
+        lines = state['lines'].split(b'\n') if state['line_nums'] else []
+        self.__init__(state['sources'], state['file_names'], state['source_ids'],
+                      state['line_nums'], state['starts'], state['ends'], lines)
+        self._source_index = {source: i for i, source in enumerate(self.sources)}
+
+    def add_source(self, file, table=None, column=None):
+        """
+        Register where matches come from.
+
+        Args:
+            file (str): File path
+            table (str): Table name, for database matches
+            column (str): Column name, for database matches
+
+        Returns:
+            int: Source id to pass to append
+        """
+        source = (file, table, column)
+        source_id = self._source_index.get(source)
+        if source_id is None:
+            source_id = self._source_index[source] = len(self.sources)
+            self.sources.append(source)
+            # Base name taken once here rather than per match when formatting
+            self.file_names.append(os.fsencode(os.path.basename(file)))
+        return source_id
+
+    def append(self, source_id, line_num, line, start, end):
+        """
+        Record one match.
+
+        Args:
+            source_id (int): Id returned by add_source
+            line_num (int): Line number, or row for database matches
+            line (bytes): Matched line, UTF-8 encoded
+            start (int): Match start within the line, in bytes
+            end (int): Match end within the line, in bytes
+        """
+        self.source_ids.append(source_id)
+        self.line_nums.append(line_num)
+        self.starts.append(start)
+        self.ends.append(end)
+        self.lines.append(line)
+
+    def extend(self, other):
+        """
+        Append all matches of another MatchSet.
+
+        Args:
+            other (MatchSet): Matches to add
+        """
+        if not self.sources:
+            # Common case when merging per-file results: ids carry over as-is
+            self.sources.extend(other.sources)
+            self.file_names.extend(other.file_names)
+            self._source_index.update(other._source_index)
+            self.source_ids.extend(other.source_ids)
+        else:
+            remap = [self.add_source(*source) for source in other.sources]
+            self.source_ids.extend(array('q', (remap[i] for i in other.source_ids)))
+        self.line_nums.extend(other.line_nums)
+        self.starts.extend(other.starts)
+        self.ends.extend(other.ends)
+        self.lines.extend(other.lines)
+
 
 def log_error(message):
     """
@@ -23,24 +196,639 @@ def log_error(message):
     print(f"Error: {message}", file=sys.stderr)
 
 
-def read_file_lines(file_path):
+@contextmanager
+def open_file_buffer(file_path):
     """
-    Read all lines from a file.
+    Open the raw contents of a file as a read-only buffer.
+
+    Files of MMAP_MIN_SIZE bytes or more are memory-mapped, so they are
+    searched straight from the page cache instead of being copied into
+    memory. Smaller files are read, which is cheaper than setting up a map.
+
+    The file is handled through its raw descriptor: a small file costs one
+    open, fstat, read and close, without the extra calls a buffered file
+    object makes, which adds up when scanning many small files.
+
+    A mapped file that is truncated while it is searched, as copytruncate
+    log rotation does, raises SIGBUS on the next access to a page past the
+    new end, which kills the process. scan_and_search rescans the files a
+    crashed pool worker left over.
 
     Args:
         file_path (Path): Path to the file
 
+    Yields:
+        bytes or mmap.mmap: File contents
+    """
+    fd = os.open(file_path, os.O_RDONLY | getattr(os, 'O_BINARY', 0))
+    try:
+        size = os.fstat(fd).st_size
+        if size < MMAP_MIN_SIZE:
+            yield read_fd(fd, size)
+        else:
+            with mmap.mmap(fd, 0, access=mmap.ACCESS_READ) as mm:
+                if hasattr(mm, 'madvise') and hasattr(mmap, 'MADV_SEQUENTIAL'):
+                    # The map is read front to back; ask for aggressive read-ahead
+                    mm.madvise(mmap.MADV_SEQUENTIAL)
+                yield mm
+    finally:
+        os.close(fd)
+
+
+def read_fd(fd, size):
+    """
+    Read a file's contents from a raw descriptor.
+
+    Args:
+        fd (int): Open file descriptor
+        size (int): File size reported by fstat
+
+    Returns:
+        bytes: File contents
+    """
+    if size:
+        return os.read(fd, size)
+
+    # Pseudo files may report a size of 0; read them until EOF
+    chunks = []
+    while True:
+        chunk = os.read(fd, MMAP_MIN_SIZE)
+        if not chunk:
+            return b''.join(chunks)
+        chunks.append(chunk)
+
+
+def count_newlines(data, start, end):
+    """
+    Count the newlines in data[start:end].
+
+    mmap objects have no count(), so they are counted in MMAP_CHUNK_SIZE
+    sized slices to keep the copies small.
+
+    Args:
+        data (bytes, str or mmap.mmap): Buffer being searched
+        start (int): Start offset
+        end (int): End offset
+
+    Returns:
+        int: Number of newlines
+    """
+    if isinstance(data, str):
+        return data.count('\n', start, end)
+    if isinstance(data, bytes):
+        return data.count(b'\n', start, end)
+    count = 0
+    for chunk_start in range(start, end, MMAP_CHUNK_SIZE):
+        count += data[chunk_start:min(chunk_start + MMAP_CHUNK_SIZE, end)].count(b'\n')
+    return count
+
+
+def is_binary(data):
+    """
+    Guess whether a buffer holds binary data.
+
+    Like grep and ripgrep, a NUL byte within the first BINARY_SNIFF_SIZE
+    bytes marks the file as binary.
+
+    Args:
+        data (bytes or mmap.mmap): File contents
+
+    Returns:
+        bool: Whether the data looks binary
+    """
+    return b'\x00' in data[:BINARY_SNIFF_SIZE]
+
+
+def drop_invalid_utf8(data):
+    """
+    Drop bytes that are not valid UTF-8, as decoding with errors='ignore' does.
+
+    Files are searched as UTF-8 text: a stray latin-1 byte must neither show
+    up in the output nor keep "er\\xffror" from matching "error". Valid
+    buffers, by far the common case, are returned as they are; a
+    memory-mapped file is checked one MMAP_CHUNK_SIZE slice at a time and
+    only read into memory if it needs cleaning.
+
+    Args:
+        data (bytes or mmap.mmap): File contents
+
+    Returns:
+        bytes or mmap.mmap: Contents that are valid UTF-8
+    """
+    if isinstance(data, bytes):
+        if data.isascii():
+            return data
+        try:
+            data.decode('utf-8')
+            return data
+        except UnicodeDecodeError:
+            return data.decode('utf-8', errors='ignore').encode('utf-8')
+
+    decoder = codecs.getincrementaldecoder('utf-8')()
+    try:
+        for start in range(0, len(data), MMAP_CHUNK_SIZE):
+            chunk = data[start:start + MMAP_CHUNK_SIZE]
+            # An ASCII chunk is valid unless it ends a character left
+            # incomplete by the previous one
+            if not chunk.isascii() or decoder.getstate()[0]:
+                decoder.decode(chunk)
+        decoder.decode(b'', final=True)
+        return data
+    except UnicodeDecodeError:
+        pass
+
+    decoder = codecs.getincrementaldecoder('utf-8')(errors='ignore')
+    parts = [
+        decoder.decode(data[start:start + MMAP_CHUNK_SIZE]).encode('utf-8')
+        for start in range(0, len(data), MMAP_CHUNK_SIZE)
+    ]
+    parts.append(decoder.decode(b'', final=True).encode('utf-8'))
+    return b''.join(parts)
+
+
+def normalize_newlines(data):
+    """
+    Translate \\r\\n and bare \\r line endings to \\n, as text mode reading does.
+
+    Lines end at \\n only, so without this "$" would sit after the \\r of
+    Windows line endings and old Mac files would read as a single line.
+    Buffers without a \\r are returned as they are. Others are translated
+    one MMAP_CHUNK_SIZE slice at a time into a single output buffer, so a
+    memory-mapped file is copied into memory once.
+
+    Args:
+        data (bytes or mmap.mmap): File contents
+
+    Returns:
+        bytes or mmap.mmap: Contents with \\n line endings only
+    """
+    if data.find(b'\r') < 0:
+        return data
+    out = io.BytesIO()
+    size = len(data)
+    for start in range(0, size, MMAP_CHUNK_SIZE):
+        end = min(start + MMAP_CHUNK_SIZE, size)
+        chunk = data[start:end]
+        if chunk.endswith(b'\r') and data[end:end + 1] == b'\n':
+            # A \r\n split over two slices; the \n ends the line
+            chunk = chunk[:-1]
+        out.write(chunk.replace(b'\r\n', b'\n').replace(b'\r', b'\n'))
+    return out.getvalue()
+
+
+class LowerCaseView:
+    """
+    Lower-cased view of a memory-mapped file for case-insensitive find().
+
+    Lower-casing the haystack once and searching it with find() is much
+    faster than matching with re.IGNORECASE, but copying a whole mapped file
+    would defeat the map. The view lower-cases one MMAP_CHUNK_SIZE window
+    at a time instead; windows overlap by len(needle) - 1 bytes, so every
+    occurrence lies entirely within the window it starts in. bytes.lower()
+    only changes ASCII letters, so offsets into the view are offsets into
+    the file.
+    """
+
+    def __init__(self, data):
+        self.data = data
+        self._size = len(data)
+        self._window_start = None
+        self._overlap = None
+        self._window = b''
+
+    def __len__(self):
+        return self._size
+
+    def find(self, needle, start=0, end=None):
+        """
+        Find a lower-case needle, like bytes.find on the lowered file.
+
+        Args:
+            needle (bytes): Lower-case byte string to find
+            start (int): Offset to search from
+            end (int): Offset the occurrence must end by
+
+        Returns:
+            int: Offset of the first occurrence, or -1 if there is none
+        """
+        end = self._size if end is None else min(end, self._size)
+        overlap = max(len(needle) - 1, 0)
+        while start + len(needle) <= end:
+            window_start = start - start % MMAP_CHUNK_SIZE
+            if window_start != self._window_start or overlap != self._overlap:
+                self._window = self.data[window_start:window_start + MMAP_CHUNK_SIZE + overlap].lower()
+                self._window_start, self._overlap = window_start, overlap
+            found = self._window.find(needle, start - window_start, end - window_start)
+            if found >= 0:
+                return window_start + found
+            start = window_start + MMAP_CHUNK_SIZE
+        return -1
+
+
+def compile_regex(pattern, flags=0):
+    """
+    Compile a user-supplied regex, using RE2 when it is installed.
+
+    RE2 matches in linear time, so patterns that make re backtrack
+    catastrophically stay fast. Patterns RE2 rejects (backreferences,
+    lookarounds) are compiled with re instead. Only byte-safe patterns reach
+    this function (see compile_text_pattern), so RE2's ASCII-only character
+    classes never change what matches.
+
+    Args:
+        pattern (str or bytes): Regex pattern
+        flags (int): re.IGNORECASE and/or re.MULTILINE
+
+    Returns:
+        Compiled pattern with the re.Pattern search interface
+    """
+    if re2 is not None:
+        inline = ('i' if flags & re.IGNORECASE else '') + ('m' if flags & re.MULTILINE else '')
+        prefix = f'(?{inline})' if inline else ''
+        if isinstance(pattern, bytes):
+            prefix = prefix.encode('ascii')
+        # Rejected patterns are expected; keep RE2 from logging each one
+        options = re2.Options()
+        options.log_errors = False
+        try:
+            return re2.compile(prefix + pattern, options=options)
+        except re2.error:
+            pass
+    return re.compile(pattern, flags)
+
+
+def byte_level_regex(pattern):
+    """
+    Check whether a regex can match part of a multibyte character.
+
+    As a bytes pattern, ".", "[^...]", class escapes such as \\w and numeric
+    escapes such as \\x80 match single bytes (or only ASCII), so they would
+    change which lines match and split characters when highlighting.
+
+    Args:
+        pattern (str): Regex pattern
+
+    Returns:
+        bool: True if the pattern has to be compiled as str
+    """
+    for token in BYTE_LEVEL_TOKEN_RE.findall(pattern):
+        if token in ('.', '[^') or token[1] in 'wWbBdDsSxX0' or len(token) == 4:
+            return True
+    return False
+
+
+@functools.lru_cache(maxsize=256)
+def newline_regex(pattern):
+    """
+    Check whether a regex has to be searched one line at a time.
+
+    Searched over a whole buffer, a regex that can match a line's newline
+    sees the next line where a single line would end the string: "\\W$"
+    would no longer match at the end of a line, and "\\s^" would match
+    across two. Worse, a search that finds nothing can run to the end of
+    the buffer from every line it starts on, which is quadratic. \\A, \\Z
+    and \\B see the string bounds by themselves.
+
+    Args:
+        pattern (str): Regex pattern
+
+    Returns:
+        bool: True if the pattern has to be searched line by line
+    """
+    for token in NEWLINE_TOKEN_RE.findall(pattern):
+        if token[0] != '\\' or len(token) > 2 or token[1] in 'nsWDxX0ABZ\n':
+            return True
+    return False
+
+
+@functools.lru_cache(maxsize=256)
+def compile_text_pattern(keyword, ignore_case=True, is_regex=False):
+    """
+    Compile the keyword for searching file buffers and database cells.
+
+    Compiled patterns are cached, so repeated searches for the same keyword
+    (and every file of a scan) reuse one compiled object. The pattern is
+    compiled as bytes so file contents can be searched without
+    decoding. Patterns that are not plain ASCII, or regexes that could match
+    part of a multibyte character (see byte_level_regex), fall back to a str
+    pattern so Unicode matching keeps working. Regexes compiled as bytes go
+    through compile_regex, so they use RE2 when it is installed, except
+    those searched line by line: each line keeps its newline, and only re's
+    $ matches before a trailing newline as the per-line search expects.
+
+    Args:
+        keyword (str): Keyword to search
+        ignore_case (bool): Whether to ignore case
+        is_regex (bool): Whether keyword is regex
+
+    Returns:
+        re.Pattern: Compiled pattern (bytes or str)
+    """
+    pattern = keyword if is_regex else re.escape(keyword)
+    # MULTILINE keeps ^ and $ anchored to lines, as in per-line matching;
+    # patterns searched line by line see each line as the whole string
+    per_line = is_regex and newline_regex(pattern)
+    flags = (0 if per_line else re.MULTILINE) | (re.IGNORECASE if ignore_case else 0)
+    if pattern.isascii() and not (is_regex and byte_level_regex(pattern)):
+        try:
+            if is_regex and not per_line:
+                return compile_regex(pattern.encode('ascii'), flags)
+            return re.compile(pattern.encode('ascii'), flags)
+        except re.error:
+            pass  # e.g. \u escapes are only valid in str patterns
+    return re.compile(pattern, flags)
+
+
+@functools.lru_cache(maxsize=256)
+def text_search_plan(keyword, ignore_case=True, is_regex=False):
+    """
+    Work out once per keyword how buffers will be searched.
+
+    Args:
+        keyword (str): Keyword to search
+        ignore_case (bool): Whether to ignore case
+        is_regex (bool): Whether keyword is regex
+
+    Returns:
+        tuple: (regex, needle, per_line), where regex is the pattern from
+            compile_text_pattern, needle is the byte string to find()
+            instead (lower-case for case-insensitive searches), or None
+            when the regex has to be used, and per_line tells whether the
+            regex has to be searched line by line (see newline_regex)
+    """
+    regex = compile_text_pattern(keyword, ignore_case, is_regex)
+    needle = None
+    if not is_regex and keyword.isascii():
+        needle = keyword.encode('ascii')
+        if ignore_case:
+            needle = needle.lower()
+    return regex, needle, is_regex and newline_regex(keyword)
+
+
+def rstrip_line(line):
+    """
+    Strip trailing whitespace from a UTF-8 line, as str.rstrip() does.
+
+    bytes.rstrip() only strips ASCII whitespace. Lines that still end in a
+    byte that can end other Unicode whitespace (no-break space, the \\x1c to
+    \\x1f separators and so on) are decoded to be stripped.
+
+    Args:
+        line (bytes): UTF-8 encoded line
+
+    Returns:
+        bytes: Line without trailing whitespace
+    """
+    line = line.rstrip()
+    if line and (line[-1] >= 0x80 or 0x1c <= line[-1] <= 0x1f):
+        line = line.decode('utf-8').rstrip().encode('utf-8')
+    return line
+
+
+def search_buffer(data, regex, matches, source_id, needle=None, haystack=None, row=None,
+                  per_line=False):
+    """
+    Search a whole buffer and record the first match on each line.
+
+    This is the one matching routine for both file contents and database
+    cells; callers only differ in the source and row they record.
+
+    The buffer is scanned by the regex engine directly; lines are only split
+    out where a match is found, and line numbers are recovered by counting
+    newlines between consecutive matches. When a needle is given, it is
+    located with find() on the haystack instead, skipping the regex engine.
+    Regexes that would see past the end of a line in the whole buffer go
+    through search_lines instead, as does the rest of the buffer once a
+    match runs into the next line.
+
+    Args:
+        data (bytes, str or mmap.mmap): File contents or cell text, as bytes
+            when regex is a bytes pattern
+        regex (re.Pattern): Pattern from compile_text_pattern
+        matches (MatchSet): Matches are appended here
+        source_id (int): Source id of the file or column in matches
+        needle (bytes): Optional literal that matches exactly what regex does
+        haystack (bytes or LowerCaseView): Buffer searched for the needle,
+            with the same offsets as data; defaults to data. Pass a
+            lower-cased haystack and needle for a case-insensitive search.
+        row (int): Row recorded for every match instead of the line number,
+            for database cells; cell lines are searched without their
+            newline, so a match cannot end on it
+        per_line (bool): Search one line at a time instead, as told by
+            text_search_plan
+    """
+    is_bytes = isinstance(regex.pattern, bytes)
+    if is_bytes:
+        newline = b'\n'
+    else:
+        if not isinstance(data, str):
+            data = str(data, 'utf-8', errors='ignore')
+        newline = '\n'
+    if haystack is None:
+        haystack = data
+
+    # Pick the match and newline counting functions once, with their lookups
+    # bound as closure constants, rather than dispatching on every match
+    if isinstance(data, (bytes, str)):
+        count_lines = functools.partial(data.count, newline)
+    else:
+        count_lines = functools.partial(count_newlines, data)
+
+    if needle is None:
+        search = regex.search
+
+        def find_match(pos, endpos):
+            match = search(data, pos, endpos)
+            return match.span() if match else None
+    else:
+        find = haystack.find
+        needle_len = len(needle)
+
+        def find_match(pos, endpos):
+            index = find(needle, pos, endpos)
+            return (index, index + needle_len) if index >= 0 else None
+
+    size = len(data)
+    # File lines are searched with their newline, as read from a file.
+    # Database cells are split on newlines, which drops them, and every line
+    # of a cell is searched, down to an empty last one.
+    kept = 1 if row is None else 0  # newline characters kept with a line
+    last = size - kept  # offset of the last line start to search
+
+    if per_line:
+        search_lines(data, regex, matches, source_id, 0, 1, row)
+        return
+
+    line_num = 1
+    counted = 0  # newlines are counted up to this offset
+    pos = 0
+    while pos <= last:
+        span = find_match(pos, size)
+        if span is None:
+            break
+
+        line_start = data.rfind(newline, 0, span[0]) + 1
+        if line_start > last:
+            break  # empty match past the trailing newline
+        line_end = data.find(newline, span[0])
+        if line_end < 0:
+            line_end = size
+
+        if span[1] > line_end + kept:
+            # The match runs into the next line. Such a regex could rescan
+            # the rest of the buffer for every line, so go line by line from
+            # here on
+            search_lines(data, regex, matches, source_id, line_start,
+                         line_num + count_lines(counted, line_start), row)
+            return
+
+        line_num += count_lines(counted, line_start)
+        counted = line_start
+        line = data[line_start:line_end]
+        start = span[0] - line_start
+        end = span[1] - line_start
+        if not is_bytes:
+            # Convert str offsets to offsets into the encoded line
+            start = len(line[:start].encode('utf-8'))
+            end = len(data[line_start:span[1]].encode('utf-8'))
+            line = line.encode('utf-8')
+        matches.append(source_id, line_num if row is None else row, rstrip_line(line), start, end)
+        pos = line_end + 1
+
+
+def search_lines(data, regex, matches, source_id, line_start=0, line_num=1, row=None):
+    """
+    Search a buffer one line at a time and record the first match on each line.
+
+    Each line is passed to the regex on its own, so it is the whole string
+    to it. search_buffer falls back to this for regexes that would see past
+    the end of a line in the whole buffer.
+
+    Args:
+        data (bytes, str or mmap.mmap): File contents or cell text, as str
+            unless regex is a bytes pattern
+        regex (re.Pattern): Pattern from compile_text_pattern
+        matches (MatchSet): Matches are appended here
+        source_id (int): Source id of the file or column in matches
+        line_start (int): Offset of the first line to search
+        line_num (int): Line number of that line
+        row (int): Row recorded for every match instead of the line number,
+            for database cells; cell lines are searched without their
+            newline
+    """
+    is_bytes = isinstance(regex.pattern, bytes)
+    newline = b'\n' if is_bytes else '\n'
+    search = regex.search
+    size = len(data)
+    kept = 1 if row is None else 0  # newline characters kept with a line
+    while line_start <= size - kept:
+        line_end = data.find(newline, line_start)
+        if line_end < 0:
+            line_end = size
+        line = data[line_start:line_end + kept]
+        match = search(line)
+        if match:
+            start, end = match.span()
+            if not is_bytes:
+                # Convert str offsets to offsets into the encoded line
+                start = len(line[:start].encode('utf-8'))
+                end = len(line[:end].encode('utf-8'))
+                line = line.encode('utf-8')
+            matches.append(source_id, line_num if row is None else row, rstrip_line(line), start, end)
+        line_num += 1
+        line_start = line_end + 1
+
+
+def row_filter_sql(column_names, keyword, ignore_case=True, is_regex=False):
+    """
+    Build a WHERE clause that lets SQLite discard rows without a match.
+
+    Plain keywords become LIKE tests, which SQLite evaluates itself. LIKE
+    ignores ASCII case, so it never drops a row a case-sensitive search
+    would keep; the exact match is still done in Python on the rows that are
+    returned. Regexes, and case-insensitive non-ASCII keywords, go through
+    the REGEXP function registered by query_database.
+
+    Args:
+        column_names (list): Column names of the table
+        keyword (str): Keyword to search
+        ignore_case (bool): Whether to ignore case
+        is_regex (bool): Whether keyword is regex
+
+    Returns:
+        tuple: (where clause, parameters)
+    """
+    quoted = [quote_identifier(name) for name in column_names]
+    if not is_regex and (keyword.isascii() or not ignore_case):
+        escaped = keyword.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+        # BLOB and REAL cells are matched on their Python str(), which SQLite
+        # text conversion does not reproduce, so they are always returned
+        where = " OR ".join(
+            f"typeof({name}) IN ('blob', 'real') OR CAST({name} AS TEXT) LIKE ?1 ESCAPE '\\'"
+            for name in quoted
+        )
+        return where, (f'%{escaped}%',)
+
+    where = " OR ".join(f"{name} REGEXP ?1" for name in quoted)
+    return where, (keyword,)
+
+
+def quote_identifier(name):
+    """
+    Quote a table or column name for use in SQL.
+
+    Args:
+        name (str): Identifier
+
+    Returns:
+        str: Identifier in double quotes
+    """
+    return '"' + name.replace('"', '""') + '"'
+
+
+def connect_read_only(db_path):
+    """
+    Open a SQLite database read-only, tuned for one bulk scan.
+
+    Args:
+        db_path (Path): Path to the database file
+
     Returns:
-        list: List of lines
+        sqlite3.Connection: Open connection
+    """
+    conn = sqlite3.connect(f'{Path(db_path).resolve().as_uri()}?mode=ro', uri=True)
+    for pragma in SQLITE_SCAN_PRAGMAS:
+        conn.execute(f'PRAGMA {pragma}')
+    return conn
+
+
+def fetch_in_batches(cursor, batch_size=FETCH_BATCH_SIZE):
+    """
+    Iterate over a cursor's result rows without fetching them all at once.
+
+    Args:
+        cursor (sqlite3.Cursor): Cursor with an executed query
+        batch_size (int): Number of rows fetched per call
+
+    Yields:
+        tuple: Result rows
     """
-    with open(file_path, 'r', encoding='utf-8', errors='ignore') as f:
-        return f.readlines()
+    while True:
+        rows = cursor.fetchmany(batch_size)
+        if not rows:
+            break
+        yield from rows
 
 
 def query_database(db_path, keyword, ignore_case=True, is_regex=False):
     """
     Query a SQLite database for the keyword in all tables and columns.
 
+    Rows are filtered inside SQLite (see row_filter_sql) and streamed in
+    batches, so only candidate rows are fetched; their cells are then
+    searched line by line with search_buffer, like file contents. Rows are
+    identified by rowid.
+
     Args:
         db_path (Path): Path to the database file
         keyword (str): Keyword to search
@@ -48,11 +836,31 @@ def query_database(db_path, keyword, ignore_case=True, is_regex=False):
         is_regex (bool): Whether keyword is regex
 
     Returns:
-        list: List of match dictionaries
+        MatchSet: Matches found
     """
-    matches = []
+    matches = MatchSet()
+    regex, needle, per_line = text_search_plan(keyword, ignore_case, is_regex)
+    encode_cells = isinstance(regex.pattern, bytes)
+
+    def cell_buffer(cell_value):
+        cell_str = str(cell_value)
+        return cell_str.encode('utf-8') if encode_cells else cell_str
+
+    def cell_matches(_pattern, cell_value):
+        """REGEXP implementation: whether the cell may hold a match."""
+        # A match spanning lines is let through; search_buffer has the
+        # final say on the returned rows
+        if cell_value is None:
+            return False
+        data = cell_buffer(cell_value)
+        if per_line:
+            newline = b'\n' if encode_cells else '\n'
+            return any(regex.search(line) for line in data.split(newline))
+        return regex.search(data) is not None
+
     try:
-        conn = sqlite3.connect(str(db_path))
+        conn = connect_read_only(db_path)
+        conn.create_function('REGEXP', 2, cell_matches, deterministic=True)
         cursor = conn.cursor()
 
         # Get all table names
@@ -62,38 +870,41 @@ def query_database(db_path, keyword, ignore_case=True, is_regex=False):
         for table_name, in tables:
             try:
                 # Get column names for this table
-                cursor.execute(f"PRAGMA table_info({table_name})")
+                table = quote_identifier(table_name)
+                cursor.execute(f"PRAGMA table_info({table})")
                 columns = cursor.fetchall()
                 column_names = [col[1] for col in columns]
 
-                # Query all data from this table
-                cursor.execute(f"SELECT * FROM {table_name}")
-                rows = cursor.fetchall()
+                where, params = row_filter_sql(column_names, keyword, ignore_case, is_regex)
+                # A column named rowid shadows the real one; use the first
+                # alias that is not a column name
+                taken = {name.lower() for name in column_names}
+                rowid = next((alias for alias in ROWID_ALIASES if alias not in taken), None)
+                selected = False
+                if rowid is not None:
+                    try:
+                        cursor.execute(f"SELECT {rowid}, * FROM {table} WHERE {where}", params)
+                        selected = True
+                    except sqlite3.OperationalError:
+                        pass  # WITHOUT ROWID table
+                if not selected:
+                    # No usable rowid: number rows by position instead
+                    cursor.execute(
+                        f"SELECT * FROM (SELECT ROW_NUMBER() OVER () AS _monitor_row_, * "
+                        f"FROM {table}) WHERE {where}",
+                        params
+                    )
 
-                for row_idx, row in enumerate(rows, 1):
+                column_sources = [matches.add_source(str(db_path), table_name, name) for name in column_names]
+                for row_idx, *row in fetch_in_batches(cursor):
                     for col_idx, cell_value in enumerate(row):
                         if cell_value is not None:
-                            cell_str = str(cell_value)
-                            lines = cell_str.split('\n')  # Handle multi-line content
-
-                            for line_idx, line in enumerate(lines, 1):
-                                if is_regex:
-                                    pattern = keyword
-                                else:
-                                    pattern = re.escape(keyword)
-
-                                flags = re.IGNORECASE if ignore_case else 0
-                                match = re.search(pattern, line, flags)
-                                if match:
-                                    matches.append({
-                                        'file': str(db_path),
-                                        'table': table_name,
-                                        'column': column_names[col_idx] if col_idx < len(column_names) else f'col_{col_idx}',
-                                        'row': row_idx,
-                                        'line': line.rstrip(),
-                                        'start': match.start(),
-                                        'end': match.end()
-                                    })
+                            if col_idx >= len(column_sources):
+                                column_sources.append(matches.add_source(str(db_path), table_name, f'col_{col_idx}'))
+                            data = cell_buffer(cell_value)
+                            haystack = data.lower() if needle is not None and ignore_case else None
+                            search_buffer(data, regex, matches, column_sources[col_idx],
+                                          needle, haystack, row=row_idx, per_line=per_line)
             except sqlite3.Error as e:
                 # Skip tables that can't be queried
                 continue
@@ -107,62 +918,171 @@ def query_database(db_path, keyword, ignore_case=True, is_regex=False):
     return matches
 
 
+def find_files(root, extensions):
+    """
+    Recursively find files with one of the given extensions.
+
+    The tree is walked once with os.scandir, filtering each entry by
+    extension, instead of globbing the whole tree once per extension.
+    Symlinked directories are not followed.
+
+    Args:
+        root (Path): Directory to walk
+        extensions (set): Lower-case file extensions to keep
+
+    Yields:
+        Path: Matching file paths
+    """
+    pending = [root]
+    while pending:
+        directory = pending.pop()
+        try:
+            with os.scandir(directory) as entries:
+                for entry in entries:
+                    if entry.is_dir(follow_symlinks=False):
+                        pending.append(entry.path)
+                    elif entry.is_file() and os.path.splitext(entry.name)[1].lower() in extensions:
+                        yield Path(entry.path)
+        except OSError as e:
+            log_error(f"Error reading directory {directory}: {e}")
+
+
+def total_size(paths, limit):
+    """
+    Add up file sizes, stopping as soon as the total reaches limit.
+
+    Args:
+        paths (list): File paths
+        limit (int): Size in bytes past which the exact total does not matter
+
+    Returns:
+        int: Total size in bytes, or a value of at least limit
+    """
+    total = 0
+    for path in paths:
+        try:
+            total += os.stat(path).st_size
+        except OSError:
+            continue  # reported when the file is scanned
+        if total >= limit:
+            break
+    return total
+
+
+def scan_file(file_path, keyword, ignore_case=True, is_regex=False, search_binary=False):
+    """
+    Search a single file for the keyword.
+
+    Text files that look binary (see is_binary) are skipped unless
+    search_binary is set.
+
+    Args:
+        file_path (Path): Path to the file
+        keyword (str): Keyword to search
+        ignore_case (bool): Whether to ignore case
+        is_regex (bool): Whether keyword is regex
+        search_binary (bool): Whether to search binary files as text
+
+    Returns:
+        MatchSet: Matches found
+    """
+    matches = MatchSet()
+    try:
+        # Handle database files differently
+        if file_path.suffix.lower() in ['.db', '.sqlite', '.sqlite3']:
+            matches = query_database(file_path, keyword, ignore_case, is_regex)
+        else:
+            # Handle text files as one buffer
+            regex, needle, per_line = text_search_plan(keyword, ignore_case, is_regex)
+            with open_file_buffer(file_path) as buffer:
+                if not search_binary and is_binary(buffer):
+                    return matches
+                data = normalize_newlines(drop_invalid_utf8(buffer))
+
+                haystack = None
+                if needle is not None:
+                    # Plain keywords are found with find(); case-insensitive
+                    # ones by lower-casing the haystack once
+                    haystack = data
+                    if ignore_case:
+                        haystack = data.lower() if isinstance(data, bytes) else LowerCaseView(data)
+
+                    # Most files hold no match; rule them out with a single
+                    # substring scan before searching for lines
+                    if haystack.find(needle) < 0:
+                        return matches
+
+                source_id = matches.add_source(str(file_path))
+                search_buffer(data, regex, matches, source_id, needle, haystack, per_line=per_line)
+    except Exception as e:
+        log_error(f"Error reading {file_path}: {e}")
+
+    return matches
+
+
+def _scan_file_task(args):
+    """Unpack a scan_file call for ProcessPoolExecutor.map."""
+    return scan_file(*args)
+
+
 def scan_and_search(path, keyword, supported_extensions, file_type_filter=None,
-                   ignore_case=True, is_regex=False, context_lines=0):
+                   ignore_case=True, is_regex=False, context_lines=0, search_binary=False):
     """
     Scan the given path (file or directory) and search for the keyword.
 
+    Directory scans holding enough data (see PARALLEL_MIN_BYTES) are spread
+    over a process pool; results keep the order in which files were found.
+    If a worker dies, the files whose results were not collected are scanned
+    in this process instead.
+
     Args:
         path (Path): Path to file or directory
         keyword (str): Keyword to search
-        supported_extensions (set): Set of supported file extensions
+        supported_extensions (iterable): Supported file extensions
         file_type_filter (str): Optional file type filter
         ignore_case (bool): Whether to ignore case
         is_regex (bool): Whether keyword is regex
         context_lines (int): Number of context lines
+        search_binary (bool): Whether to search binary files as text
 
     Returns:
-        list: List of match dictionaries with file, line_num, line, start, end
+        MatchSet: Matches found
     """
-    matches = []
+    matches = MatchSet()
 
     if path.is_file():
         files_to_scan = [path]
     else:
-        files_to_scan = []
-        for ext in supported_extensions:
-            if file_type_filter and ext != file_type_filter:
-                continue
-            files_to_scan.extend(path.rglob(f'*{ext}'))
+        extensions = {ext.lower() for ext in supported_extensions}
+        if file_type_filter:
+            extensions &= {file_type_filter.lower()}
+        files_to_scan = list(find_files(path, extensions))
 
-    flags = re.IGNORECASE if ignore_case else 0
+    # Compile up front so an invalid pattern fails before any file is read;
+    # workers compile their own copy once through the same cache
+    text_search_plan(keyword, ignore_case, is_regex)
+    tasks = [(file_path, keyword, ignore_case, is_regex, search_binary) for file_path in files_to_scan]
 
-    for file_path in files_to_scan:
+    workers = min(os.cpu_count() or 1, len(tasks))
+    if multiprocessing.get_start_method() == 'fork':
+        min_bytes = PARALLEL_MIN_BYTES
+    else:
+        min_bytes = PARALLEL_MIN_BYTES_SPAWNED
+    done = 0  # tasks whose matches have been collected
+    if workers > 1 and total_size(files_to_scan, min_bytes) >= min_bytes:
+        # Several tasks per chunk to amortize the IPC round trips
+        chunksize = max(1, len(tasks) // (workers * 4))
         try:
-            # Handle database files differently
-            if file_path.suffix.lower() in ['.db', '.sqlite', '.sqlite3']:
-                db_matches = query_database(file_path, keyword, ignore_case, is_regex)
-                matches.extend(db_matches)
-            else:
-                # Handle text files as before
-                lines = read_file_lines(file_path)
-                for line_num, line in enumerate(lines, 1):
-                    if is_regex:
-                        pattern = keyword
-                    else:
-                        pattern = re.escape(keyword)
-
-                    match = re.search(pattern, line, flags)
-                    if match:
-                        matches.append({
-                            'file': str(file_path),
-                            'line_num': line_num,
-                            'line': line.rstrip(),
-                            'start': match.start(),
-                            'end': match.end()
-                        })
-        except Exception as e:
-            log_error(f"Error reading {file_path}: {e}")
+            with ProcessPoolExecutor(max_workers=workers) as executor:
+                for file_matches in executor.map(_scan_file_task, tasks, chunksize=chunksize):
+                    matches.extend(file_matches)
+                    done += 1
+        except BrokenProcessPool:
+            # A worker died, e.g. of SIGBUS on a mapped file truncated by log
+            # rotation; the files it left are rescanned here
+            log_error("A scan worker died; scanning the remaining files without the pool")
+    for task in tasks[done:]:
+        matches.extend(_scan_file_task(task))
 
     return matches
 
@@ -171,47 +1091,67 @@ def highlight_matches(matches, keyword, is_regex=False):
     """
     Highlight the keyword in the matched lines using ANSI colors.
 
+    Lines are assembled as bytes from the stored UTF-8 line bytes, so
+    nothing is decoded or re-encoded on the way to the output.
+
     Args:
-        matches (list): List of match dicts
+        matches (MatchSet): Matches to format
         keyword (str): Keyword to highlight
         is_regex (bool): Whether keyword is regex
 
     Returns:
-        list: List of formatted strings with highlights
+        list: List of formatted byte strings with highlights
     """
-    highlighted_lines = []
-    for match in matches:
-        # Handle database matches differently
-        if 'table' in match:
-            file_name = Path(match['file']).name
-            table = match['table']
-            column = match['column']
-            row = match['row']
-            line = match['line']
-            start, end = match['start'], match['end']
-
-            # ANSI escape codes for bold red
-            highlight_start = '\033[1;31m'
-            highlight_end = '\033[0m'
-
-            highlighted_line = f"{highlight_start}{line[start:end]}{highlight_end}"
-            full_line = f"[{file_name}:{table}.{column}:row{row}] {line[:start]}{highlighted_line}{line[end:]}"
+    # Build the "[file:" or "[file:table.column:row" prefix once per source
+    prefixes = []
+    for (_, table, column), file_name in zip(matches.sources, matches.file_names):
+        if table is None:
+            prefixes.append(b'[' + file_name + b':')
         else:
-            # Handle text file matches
-            file_name = Path(match['file']).name
-            line = match['line']
-            start, end = match['start'], match['end']
+            # Handle database matches differently
+            prefixes.append(b'[' + file_name + f':{table}.{column}:row'.encode('utf-8'))
 
-            # ANSI escape codes for bold red
-            highlight_start = '\033[1;31m'
-            highlight_end = '\033[0m'
+    highlighted_lines = []
+    source_ids, line_nums = matches.source_ids, matches.line_nums
+    starts, ends, lines = matches.starts, matches.ends, matches.lines
+    for i in range(len(lines)):
+        line = lines[i]
+        start, end = starts[i], ends[i]
+        highlighted_lines.append(b''.join((
+            prefixes[source_ids[i]], b'%d] ' % line_nums[i],
+            line[:start], HIGHLIGHT_START, line[start:end], HIGHLIGHT_END, line[end:]
+        )))
 
-            highlighted_line = f"{highlight_start}{line[start:end]}{highlight_end}"
-            full_line = f"[{file_name}:{match['line_num']}] {line[:start]}{highlighted_line}{line[end:]}"
+    return highlighted_lines
 
-        highlighted_lines.append(full_line)
 
-    return highlighted_lines
+def write_lines(lines):
+    """
+    Write lines to stdout through one large buffer, flushed once at the end.
+
+    Lines are written one at a time; the buffer coalesces them into
+    OUTPUT_BUFFER_SIZE writes without holding a joined copy of the output.
+
+    Args:
+        lines (list): UTF-8 encoded lines, without trailing newlines
+    """
+    sys.stdout.flush()
+    stdout_buffer = getattr(sys.stdout, 'buffer', None)
+    if stdout_buffer is None:
+        # stdout has been replaced by a text-only stream
+        for line in lines:
+            sys.stdout.write(line.decode('utf-8', errors='replace') + '\n')
+        return
+
+    out = io.BufferedWriter(stdout_buffer, buffer_size=OUTPUT_BUFFER_SIZE)
+    try:
+        write = out.write
+        for line in lines:
+            write(line + b'\n')
+        out.flush()
+    finally:
+        # Leave sys.stdout usable once the wrapper goes away
+        out.detach()
 
 
 def main():
@@ -233,6 +1173,7 @@ Examples:
     parser.add_argument('--context-lines', type=int, default=0, help='Number of context lines around matches')
     parser.add_argument('--regex', action='store_true', help='Treat keyword as regex pattern')
     parser.add_argument('--export', help='Export results to file (txt or csv)')
+    parser.add_argument('--text', action='store_true', help='Search binary files as if they were text')
 
     args = parser.parse_args()
 
@@ -246,12 +1187,11 @@ Examples:
 
     try:
         matches = scan_and_search(path, args.keyword, supported_extensions, args.file_type,
-                                args.ignore_case, args.regex, args.context_lines)
+                                args.ignore_case, args.regex, args.context_lines, args.text)
 
         if matches:
             highlighted = highlight_matches(matches, args.keyword, args.regex)
-            for line in highlighted:
-                print(line)
+            write_lines(highlighted)
             print(f"\nTotal matches found: {len(matches)}")
         else:
             print("No matches found.")
@@ -260,6 +1200,14 @@ Examples:
             # Implement export later if needed
             pass
 
+    except BrokenPipeError:
+        # Output was cut short (e.g. piped into head); discard what is left
+        devnull = os.open(os.devnull, os.O_WRONLY)
+        os.dup2(devnull, sys.stdout.fileno())
+        sys.exit(1)
+    except re.error as e:
+        log_error(f"Invalid regex pattern '{args.keyword}': {e}")
+        sys.exit(1)
     except Exception as e:
         log_error(f"An error occurred: {e}")
         sys.exit(1)
@@ -0,0 +1,375 @@
+"""
+Regression tests for monitor.py matching.
+
+Run with: python -m unittest test_monitor
+"""
+
+import re
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import time
+import unittest
+from pathlib import Path
+from unittest import mock
+
+import monitor
+
+
+class SearchTestCase(unittest.TestCase):
+    """Base class writing fixture files to a temporary directory."""
+
+    def setUp(self):
+        self._tmp = tempfile.TemporaryDirectory()
+        self.root = Path(self._tmp.name)
+
+    def tearDown(self):
+        self._tmp.cleanup()
+
+    def write(self, name, content):
+        path = self.root / name
+        path.write_bytes(content)
+        return path
+
+    def search(self, path, keyword, is_regex=False, ignore_case=True):
+        return monitor.scan_and_search(path, keyword, ['.log'], ignore_case=ignore_case,
+                                       is_regex=is_regex)
+
+    def matched(self, matches):
+        """(line_num, line, matched text) for each match, decoded."""
+        return [
+            (matches.line_nums[i], matches.lines[i].decode('utf-8'),
+             matches.lines[i][matches.starts[i]:matches.ends[i]].decode('utf-8'))
+            for i in range(len(matches))
+        ]
+
+
+class UnicodeRegexTest(SearchTestCase):
+    """Regexes must match characters, not bytes, of UTF-8 text."""
+
+    def test_dot_counts_characters(self):
+        path = self.write('a.log', 'café\nabcd\n'.encode('utf-8'))
+        matches = self.search(path, r'^.{4}$', is_regex=True)
+        self.assertEqual(self.matched(matches), [(1, 'café', 'café'), (2, 'abcd', 'abcd')])
+
+    def test_negated_class_counts_characters(self):
+        path = self.write('a.log', 'x€y\n'.encode('utf-8'))
+        matches = self.search(path, r'x[^a]y', is_regex=True)
+        self.assertEqual(self.matched(matches), [(1, 'x€y', 'x€y')])
+
+    def test_highlight_keeps_characters_whole(self):
+        path = self.write('b.log', '€uro\n'.encode('utf-8'))
+        matches = self.search(path, '.', is_regex=True)
+        highlighted = monitor.highlight_matches(matches, '.', is_regex=True)
+        self.assertEqual(highlighted, [
+            b'[b.log:1] ' + monitor.HIGHLIGHT_START + '€'.encode('utf-8')
+            + monitor.HIGHLIGHT_END + b'uro'
+        ])
+
+    def test_invalid_bytes_dropped(self):
+        path = self.write('a.log', b'caf\xe9 error\n\xff\xfeer\xffror\n')
+        self.assertEqual(self.matched(self.search(path, 'error')),
+                         [(1, 'caf error', 'error'), (2, 'error', 'error')])
+        self.assertEqual(self.matched(self.search(path, 'r.or', is_regex=True)),
+                         [(1, 'caf error', 'rror'), (2, 'error', 'rror')])
+
+    def test_invalid_bytes_dropped_memory_mapped(self):
+        content = b'filler line\n' * (monitor.MMAP_MIN_SIZE // 12 + 1) + b'er\xffror\n'
+        path = self.write('big.log', content)
+        self.assertEqual(self.matched(self.search(path, 'error')),
+                         [(content.count(b'\n'), 'error', 'error')])
+
+    def test_utf8_split_across_mmap_chunks(self):
+        padding = b'x' * (monitor.MMAP_CHUNK_SIZE - 1)
+        data = padding + 'é error\n'.encode('utf-8')
+        self.assertEqual(monitor.drop_invalid_utf8(data), data)
+        path = self.write('big.log', data)
+        with monitor.open_file_buffer(path) as buffer:
+            self.assertIs(monitor.drop_invalid_utf8(buffer), buffer)
+
+    def test_unicode_trailing_whitespace_stripped(self):
+        path = self.write('a.log', 'error\u00a0\nerror\x1f\u3000\n'.encode('utf-8'))
+        self.assertEqual(self.matched(self.search(path, 'error')),
+                         [(1, 'error', 'error'), (2, 'error', 'error')])
+
+    def test_ascii_regex_stays_bytes(self):
+        self.assertIsInstance(monitor.compile_text_pattern('err(or)?', True, True).pattern, bytes)
+        self.assertIsInstance(monitor.compile_text_pattern(r'a\.b', True, True).pattern, bytes)
+        self.assertIsInstance(monitor.compile_text_pattern('a.b', True, True).pattern, str)
+
+
+class NewlineRegexTest(SearchTestCase):
+    """Regexes that can match a newline still see one line at a time."""
+
+    def test_non_word_at_line_end(self):
+        path = self.write('a.log', b'caf!\nabcd\n')
+        matches = self.search(path, r'\w\W$', is_regex=True)
+        self.assertEqual(self.matched(matches), [(1, 'caf!', 'f!'), (2, 'abcd', 'd')])
+
+    def test_no_match_across_lines(self):
+        path = self.write('a.log', b'one\ntwo\n')
+        matches = self.search(path, r'\s^', is_regex=True)
+        self.assertEqual(self.matched(matches), [])
+
+    def test_match_running_into_next_line(self):
+        path = self.write('a.log', b'abc\ndef\n')
+        matches = self.search(path, r'[^x]+', is_regex=True)
+        self.assertEqual(self.matched(matches), [(1, 'abc', 'abc'), (2, 'def', 'def')])
+
+    def test_failed_search_stays_linear(self):
+        # Searched over the whole buffer, every line would rescan the rest
+        # of the file; on this file that took many seconds
+        path = self.write('a.log', b'abcdefghij\n' * 4400)
+        started = time.perf_counter()
+        matches = self.search(path, '[^x]*z', is_regex=True)
+        self.assertEqual(len(matches), 0)
+        self.assertLess(time.perf_counter() - started, 2)
+
+
+class LineEndingTest(SearchTestCase):
+    """\\r\\n and bare \\r end lines, as when files were read in text mode."""
+
+    def test_crlf_line_end_anchor(self):
+        path = self.write('a.log', b'ok\r\nerror\r\nok\r\n')
+        matches = self.search(path, 'error$', is_regex=True)
+        self.assertEqual(self.matched(matches), [(2, 'error', 'error')])
+
+    def test_bare_cr_lines(self):
+        path = self.write('a.log', b'error one\rerror two\r')
+        matches = self.search(path, 'error')
+        self.assertEqual(self.matched(matches), [(1, 'error one', 'error'), (2, 'error two', 'error')])
+
+    def test_crlf_memory_mapped(self):
+        content = b'filler line\r\n' * (monitor.MMAP_MIN_SIZE // 13 + 1) + b'last error\r\n'
+        path = self.write('big.log', content)
+        matches = self.search(path, 'error$', is_regex=True)
+        self.assertEqual(self.matched(matches), [(content.count(b'\n'), 'last error', 'error')])
+
+    def test_crlf_split_across_mmap_chunks(self):
+        content = b'x' * (monitor.MMAP_CHUNK_SIZE - 1) + b'\r\nerror\r\n'
+        path = self.write('big.log', content)
+        matches = self.search(path, 'error$', is_regex=True)
+        self.assertEqual(self.matched(matches), [(2, 'error', 'error')])
+
+
+@unittest.skipUnless(monitor.re2, 'google-re2 is not installed')
+class Re2Test(SearchTestCase):
+    """Regexes compiled with the optional RE2 engine."""
+
+    def test_rejected_pattern_is_quiet(self):
+        path = self.write('a.log', b'ERROR: x\n')
+        result = subprocess.run(
+            [sys.executable, monitor.__file__, str(path), 'ERROR(?=:)', '--regex'],
+            capture_output=True, check=True
+        )
+        self.assertEqual(result.stderr, b'')
+        self.assertIn(b'Total matches found: 1', result.stdout)
+
+    def test_engine_choice(self):
+        for pattern in ('ERROR|FATAL', 'timeout[0-9]+', '^WARN'):
+            self.assertNotIsInstance(monitor.compile_text_pattern(pattern, True, True), re.Pattern)
+        for pattern in ('user=.*', r'a\d', r'x\n', r'(a)\1'):
+            self.assertIsInstance(monitor.compile_text_pattern(pattern, True, True), re.Pattern)
+
+    def test_line_end_before_newline(self):
+        path = self.write('a.log', b'ERROR: x\nline\n')
+        matches = self.search(path, '$\n', is_regex=True)
+        self.assertEqual(self.matched(matches), [(1, 'ERROR: x', ''), (2, 'line', '')])
+
+
+class ScanTest(SearchTestCase):
+    """Directory scans."""
+
+    def test_small_scan_runs_without_pool(self):
+        for i in range(8):
+            self.write(f'{i}.log', b'error\nok\n')
+        with mock.patch.object(monitor.os, 'cpu_count', return_value=8), \
+                mock.patch.object(monitor, 'ProcessPoolExecutor', side_effect=AssertionError('pool started')):
+            matches = self.search(self.root, 'error')
+        self.assertEqual(len(matches), 8)
+
+    def test_broken_pool_rescans_remaining_files(self):
+        class BrokenPool:
+            """Pool whose worker dies after the first task."""
+
+            def __init__(self, max_workers):
+                pass
+
+            def __enter__(self):
+                return self
+
+            def __exit__(self, *exc_info):
+                return False
+
+            def map(self, fn, tasks, chunksize=1):
+                yield fn(tasks[0])
+                raise monitor.BrokenProcessPool('worker died')
+
+        for i in range(3):
+            self.write(f'{i}.log', b'error\n')
+        with mock.patch.object(monitor.os, 'cpu_count', return_value=8), \
+                mock.patch.object(monitor, 'PARALLEL_MIN_BYTES', 0), \
+                mock.patch.object(monitor, 'PARALLEL_MIN_BYTES_SPAWNED', 0), \
+                mock.patch.object(monitor, 'ProcessPoolExecutor', BrokenPool), \
+                mock.patch.object(monitor, 'log_error') as log_error:
+            matches = self.search(self.root, 'error')
+        self.assertEqual(sorted(matches.file_names), [b'0.log', b'1.log', b'2.log'])
+        self.assertEqual(len(matches), 3)
+        log_error.assert_called_once()
+
+    def test_find_files_filters_extensions(self):
+        (self.root / 'sub').mkdir()
+        self.write('a.log', b'')
+        self.write('B.LOG', b'')
+        self.write('c.txt', b'')
+        self.write('sub/d.log', b'')
+        self.write('log', b'')
+        found = {p.relative_to(self.root).as_posix() for p in monitor.find_files(self.root, {'.log'})}
+        self.assertEqual(found, {'a.log', 'B.LOG', 'sub/d.log'})
+
+    def test_find_files_skips_symlinked_dirs(self):
+        (self.root / 'real').mkdir()
+        self.write('real/a.log', b'')
+        (self.root / 'link').symlink_to(self.root / 'real', target_is_directory=True)
+        found = [p.relative_to(self.root).as_posix() for p in monitor.find_files(self.root, {'.log'})]
+        self.assertEqual(found, ['real/a.log'])
+
+    def test_file_type_filter_with_extension_list(self):
+        self.write('a.log', b'error\n')
+        self.write('b.sql', b'error\n')
+        matches = monitor.scan_and_search(self.root, 'error', ['.log', '.sql'], '.LOG')
+        self.assertEqual([matches.file_names[i] for i in matches.source_ids], [b'a.log'])
+
+
+class BinaryFileTest(SearchTestCase):
+    """Files with a NUL byte near the start are skipped unless --text is given."""
+
+    def test_binary_file_skipped(self):
+        path = self.write('a.log', b'error\x00\nerror\n')
+        self.assertEqual(len(self.search(path, 'error')), 0)
+
+    def test_binary_file_searched_as_text(self):
+        path = self.write('a.log', b'error\x00\nerror\n')
+        matches = monitor.scan_and_search(path, 'error', ['.log'], search_binary=True)
+        self.assertEqual([m[0] for m in self.matched(matches)], [1, 2])
+
+    def test_nul_past_sniffed_bytes(self):
+        path = self.write('a.log', b'x' * monitor.BINARY_SNIFF_SIZE + b'\x00\nerror\n')
+        self.assertEqual(self.matched(self.search(path, 'error')), [(2, 'error', 'error')])
+
+    def test_text_flag(self):
+        path = self.write('a.log', b'error\x00\n')
+        run = [sys.executable, monitor.__file__, str(path), 'error']
+        self.assertIn(b'No matches found.', subprocess.run(run, capture_output=True).stdout)
+        self.assertIn(b'Total matches found: 1',
+                      subprocess.run(run + ['--text'], capture_output=True).stdout)
+
+
+class LowerCaseViewTest(SearchTestCase):
+    """Case-insensitive find() over a memory-mapped file, window by window."""
+
+    def test_needle_across_window_boundary(self):
+        boundary = monitor.MMAP_CHUNK_SIZE
+        content = bytearray(b'x' * (boundary * 2 + 16))
+        content[boundary - 2:boundary + 3] = b'ERROR'
+        content[boundary * 2 - 1:boundary * 2 + 4] = b'eRrOr'
+        path = self.write('big.log', bytes(content))
+        with monitor.open_file_buffer(path) as buffer:
+            view = monitor.LowerCaseView(buffer)
+            self.assertEqual(view.find(b'error'), boundary - 2)
+            self.assertEqual(view.find(b'error', boundary - 1), boundary * 2 - 1)
+            # The occurrence must end by end, even when it starts before it
+            self.assertEqual(view.find(b'error', 0, boundary + 2), -1)
+            self.assertEqual(view.find(b'error', 0, boundary + 3), boundary - 2)
+            self.assertEqual(view.find(b'error', boundary * 2), -1)
+            self.assertEqual(view.find(b'x', len(view) - 1), len(view) - 1)
+
+    def test_case_insensitive_search_memory_mapped(self):
+        content = b'x' * (monitor.MMAP_CHUNK_SIZE - 3) + b'\nERROR here\n'
+        path = self.write('big.log', content)
+        self.assertEqual(self.matched(self.search(path, 'error')), [(2, 'ERROR here', 'ERROR')])
+
+
+class DatabaseTest(SearchTestCase):
+    """Rows of SQLite tables are searched cell by cell."""
+
+    def create_db(self, *statements):
+        path = self.root / 'r.db'
+        conn = sqlite3.connect(path)
+        for statement in statements:
+            conn.execute(statement)
+        conn.commit()
+        conn.close()
+        return path
+
+    def rows(self, matches):
+        """(column, row, line) for each match."""
+        return [
+            (matches.sources[matches.source_ids[i]][2], matches.line_nums[i],
+             matches.lines[i].decode('utf-8'))
+            for i in range(len(matches))
+        ]
+
+    def test_rowid_column(self):
+        path = self.create_db(
+            "CREATE TABLE t (rowid TEXT, v TEXT)",
+            "INSERT INTO t VALUES ('abc', 'miss')",
+            "INSERT INTO t VALUES ('def', 'hit')",
+        )
+        self.assertEqual(self.rows(monitor.query_database(path, 'hit')), [('v', 2, 'hit')])
+
+    def test_integer_rowid_column(self):
+        path = self.create_db(
+            "CREATE TABLE t (rowid INTEGER, v TEXT)",
+            "INSERT INTO t VALUES (100, 'miss')",
+            "INSERT INTO t VALUES (200, 'hit')",
+        )
+        self.assertEqual(self.rows(monitor.query_database(path, 'hit')), [('v', 2, 'hit')])
+
+    def test_all_rowid_aliases_taken(self):
+        path = self.create_db(
+            "CREATE TABLE t (rowid TEXT, _rowid_ TEXT, oid TEXT, v TEXT)",
+            "INSERT INTO t VALUES ('a', 'b', 'c', 'miss')",
+            "INSERT INTO t VALUES ('a', 'b', 'c', 'hit')",
+        )
+        self.assertEqual(self.rows(monitor.query_database(path, 'hit')), [('v', 2, 'hit')])
+
+    def test_cell_lines_exclude_newline(self):
+        path = self.create_db(
+            "CREATE TABLE t (v TEXT)",
+            "INSERT INTO t VALUES ('bar' || char(10) || 'baz')",
+        )
+        self.assertEqual(self.rows(monitor.query_database(path, 'r\n', is_regex=True)), [])
+        self.assertEqual(self.rows(monitor.query_database(path, 'r\n')), [])
+        self.assertEqual(self.rows(monitor.query_database(path, 'r$', is_regex=True)), [('v', 1, 'bar')])
+
+    def test_empty_cell_lines(self):
+        path = self.create_db(
+            "CREATE TABLE t (v TEXT)",
+            "INSERT INTO t VALUES ('a' || char(10))",
+            "INSERT INTO t VALUES ('')",
+        )
+        self.assertEqual(self.rows(monitor.query_database(path, '^$', is_regex=True)),
+                         [('v', 1, ''), ('v', 2, '')])
+
+    def test_like_wildcards_are_literal(self):
+        path = self.create_db(
+            "CREATE TABLE t (v TEXT)",
+            *(f"INSERT INTO t VALUES ('{v}')" for v in ('a%b', 'axb', 'a_b', 'ab', 'a\\b', 'a\\\\b'))
+        )
+        conn = sqlite3.connect(path)
+        try:
+            for keyword, expected in (('a%b', ['a%b']), ('a_b', ['a_b']), ('a\\b', ['a\\b']),
+                                     ('a\\\\b', ['a\\\\b'])):
+                # The prefilter itself must not let LIKE wildcards through
+                where, params = monitor.row_filter_sql(['v'], keyword)
+                rows = [v for v, in conn.execute(f"SELECT v FROM t WHERE {where}", params)]
+                self.assertEqual(rows, expected, keyword)
+        finally:
+            conn.close()
+        self.assertEqual(self.rows(monitor.query_database(path, 'a_b')), [('v', 3, 'a_b')])
+
+
+if __name__ == '__main__':
+    unittest.main()